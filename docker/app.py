@@ -1,65 +1,149 @@
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.sql import text
+from sqlalchemy import event
+from botocore.exceptions import ClientError
 import boto3
 import json
 import logging
 import os
 import psycopg2
+from psycopg2 import sql
+import random
+import time
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 # Set up logging
 app = Flask(__name__)
 
+# Credentials cache, keyed by secret ARN: {arn: (expiry, (username, password))}
+_SECRET_CACHE = {}
+SECRET_CACHE_TTL = int(os.environ.get('DB_SECRET_CACHE_TTL', 900))
+
+# boto3 clients, created once per (service, region) and reused for the life of the process
+_AWS_CLIENTS = {}
+
+def _get_client(service_name, region_name):
+    client = _AWS_CLIENTS.get((service_name, region_name))
+    if client is None:
+        client = boto3.session.Session().client(service_name, region_name=region_name)
+        _AWS_CLIENTS[(service_name, region_name)] = client
+    return client
+
+# When set, the app connects as this IAM-authenticated database user instead of the secret's user
+DB_IAM_USER = os.environ.get('DB_IAM_USER')
+
+# Error codes Secrets Manager uses when throttling GetSecretValue
+_THROTTLE_ERROR_CODES = ('ThrottlingException', 'TooManyRequestsException')
+SECRET_FETCH_ATTEMPTS = 5
+
+def _get_secret_value(client, secret_id):
+    """GetSecretValue with jittered exponential backoff on throttling"""
+    for attempt in range(SECRET_FETCH_ATTEMPTS):
+        try:
+            return client.get_secret_value(SecretId=secret_id)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in _THROTTLE_ERROR_CODES or attempt == SECRET_FETCH_ATTEMPTS - 1:
+                raise
+            delay = random.uniform(0, 2 ** attempt * 0.1)
+            logger.warning(f"Secrets Manager throttled, retrying in {delay:.2f}s")
+            time.sleep(delay)
+
 # Fetch secret from AWS Secrets Manager
 def get_db_credentials():
     secret_name = os.environ.get('DB_SECRET_ARN')
     region_name = os.environ.get('AWS_REGION', 'eu-central-1')
-    
-    client = boto3.client('secretsmanager', region_name=region_name)
-    response = client.get_secret_value(SecretId=secret_name)
+
+    cached = _SECRET_CACHE.get(secret_name)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    client = _get_client('secretsmanager', region_name)
+    response = _get_secret_value(client, secret_name)
     secret = json.loads(response['SecretString'])
-    return secret['username'], secret['password']
+    # Keep only the credentials tuple, the parsed payload is discarded
+    credentials = (secret['username'], secret['password'])
+    _SECRET_CACHE[secret_name] = (time.monotonic() + SECRET_CACHE_TTL, credentials)
+    return credentials
+
+def clear_db_credentials_cache():
+    """Drop cached credentials so the next lookup goes back to Secrets Manager"""
+    _SECRET_CACHE.clear()
+
+def get_db_auth_token(db_user):
+    """Generate an IAM auth token for db_user; it is signed locally, no network call is made"""
+    region_name = os.environ.get('AWS_REGION', 'eu-central-1')
+    return _get_client('rds', region_name).generate_db_auth_token(
+        DBHostname=os.environ.get('DB_HOST'),
+        Port=5432,
+        DBUsername=db_user,
+        Region=region_name
+    )
 
-def create_database_if_not_exists():
+def _connect(username, password, database):
+    """Open an autocommit psycopg2 connection to the given database"""
+    conn = psycopg2.connect(
+        host=os.environ.get('DB_HOST'),
+        port=5432,
+        user=username,
+        password=password,
+        database=database
+    )
+    conn.autocommit = True
+    return conn
+
+GRANT_ATTEMPTS = 5
+
+def _grant_iam_user(cursor, db_user):
+    """Create the IAM-authenticated login role and give it access to the app tables"""
+    role = sql.Identifier(db_user)
+    try:
+        cursor.execute(sql.SQL("CREATE ROLE {} LOGIN").format(role))
+        logger.info(f"Created database role {db_user}")
+    except psycopg2.errors.DuplicateObject:
+        logger.info(f"Database role {db_user} already exists")
+    # Every worker runs these at boot; concurrent GRANTs on the same role can fail with
+    # "tuple concurrently updated", so retry them (they are idempotent)
+    for attempt in range(GRANT_ATTEMPTS):
+        try:
+            cursor.execute(sql.SQL("GRANT rds_iam TO {}").format(role))
+            cursor.execute(sql.SQL("GRANT ALL ON ALL TABLES IN SCHEMA public TO {}").format(role))
+            cursor.execute(sql.SQL("GRANT ALL ON ALL SEQUENCES IN SCHEMA public TO {}").format(role))
+            return
+        except psycopg2.InternalError as e:
+            if "tuple concurrently updated" not in str(e) or attempt == GRANT_ATTEMPTS - 1:
+                raise
+            time.sleep(random.uniform(0, 2 ** attempt * 0.1))
+
+def create_database_if_not_exists(username, password):
     """Create the database if it doesn't exist"""
-    username, password = get_db_credentials()
-    db_host = os.environ.get('DB_HOST')
-    
     try:
-        # Connect to the default postgres database
-        conn = psycopg2.connect(
-            host=db_host,
-            port=5432, 
-            user=username,
-            password=password,
-            database="postgres"
-        )
-        conn.autocommit = True
-        cursor = conn.cursor()
-        
-        # Check if our database exists
-        cursor.execute("SELECT 1 FROM pg_database WHERE datname = 'flaskdb'")
-        if not cursor.fetchone():
-            logger.info("Creating flaskdb database")
-            cursor.execute("CREATE DATABASE flaskdb")
-            logger.info("Database created successfully")
-        else:
+        # Postgres can't switch databases on an open connection, so go straight to
+        # flaskdb and only fall back to the postgres database when it has to be created
+        try:
+            conn = _connect(username, password, "flaskdb")
             logger.info("Database flaskdb already exists")
+        except psycopg2.OperationalError as e:
+            if "does not exist" not in str(e):
+                raise
+            conn = _connect(username, password, "postgres")
+            cursor = conn.cursor()
             
-        cursor.close()
-        conn.close()
-        
-        # Now connect to our database to create tables
-        conn = psycopg2.connect(
-            host=db_host,
-            port=5432,
-            user=username,
-            password=password,
-            database="flaskdb"
-        )
-        conn.autocommit = True
+            # CREATE DATABASE has no IF NOT EXISTS and can't run inside a DO block, so
+            # attempt it directly and treat a duplicate (e.g. another worker won) as success
+            try:
+                logger.info("Creating flaskdb database")
+                cursor.execute("CREATE DATABASE flaskdb")
+                logger.info("Database created successfully")
+            except psycopg2.errors.DuplicateDatabase:
+                logger.info("Database flaskdb already exists")
+                
+            cursor.close()
+            conn.close()
+            
+            # Now connect to our database to create tables
+            conn = _connect(username, password, "flaskdb")
+
         cursor = conn.cursor()
         
         # Create necessary tables
@@ -70,6 +154,9 @@ def create_database_if_not_exists():
             email VARCHAR(120) UNIQUE NOT NULL
         )
         """)
+
+        if DB_IAM_USER:
+            _grant_iam_user(cursor, DB_IAM_USER)
         
         cursor.close()
         conn.close()
@@ -82,19 +169,82 @@ def create_database_if_not_exists():
         return False
 
 
+# Fetch credentials once and share them between the bootstrap and the engine URI
+username, password = get_db_credentials()
+
 # Try to create database on startup
 try:
-    create_database_if_not_exists()
+    create_database_if_not_exists(username, password)
 except Exception as e:
     logger.warning(f"Could not create database during startup: {str(e)}")
 
-username, password = get_db_credentials()
 db_host = os.environ.get('DB_HOST')
 app.config['SQLALCHEMY_DATABASE_URI'] = f"postgresql://{username}:{password}@{db_host}:5432/flaskdb"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Connection pool sizing, overridable from the task environment
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 5)),
+    'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    # Validate pooled connections before use so an Aurora failover doesn't surface as a 5xx.
+    # Behind PgBouncer transaction pooling the ping is meaningless, so rely on pool_recycle there.
+    'pool_pre_ping': os.environ.get('DB_PGBOUNCER', 'false').lower() != 'true',
+    # Pin the isolation level rather than leaving it to the server default
+    'isolation_level': 'READ COMMITTED',
+}
 
 db = SQLAlchemy(app)
 
+# New pool connections take a fresh IAM token, or the current (cached) secret credentials,
+# rather than the ones baked into the URI at startup
+def _connect_with_current_credentials(dialect, conn_rec, cargs, cparams):
+    if DB_IAM_USER:
+        cparams['user'] = DB_IAM_USER
+        cparams['password'] = get_db_auth_token(DB_IAM_USER)
+        # IAM authentication is only accepted over SSL
+        cparams['sslmode'] = 'require'
+    else:
+        cparams['user'], cparams['password'] = get_db_credentials()
+
+    try:
+        return dialect.connect(*cargs, **cparams)
+    except psycopg2.OperationalError as e:
+        if "password authentication failed" in str(e):
+            if DB_IAM_USER:
+                # Postgres reports a missing role as an auth failure, so the startup
+                # bootstrap may not have created it yet; run it again
+                create_database_if_not_exists(*get_db_credentials())
+            else:
+                # The secret may have been rotated, refetch it on the next connection attempt
+                clear_db_credentials_cache()
+        raise
+
+with app.app_context():
+    event.listen(db.engine, 'do_connect', _connect_with_current_credentials)
+
+def warm_db_pool(max_connections=None):
+    """Open pool connections up front so the first requests don't pay for the handshake.
+
+    At most pool_size connections are opened, capped at max_connections when given
+    (e.g. the worker's thread count, since it can't check out more than that at once).
+    """
+    count = app.config['SQLALCHEMY_ENGINE_OPTIONS']['pool_size']
+    if max_connections is not None:
+        count = min(count, max_connections)
+    with app.app_context():
+        conns = []
+        try:
+            for _ in range(count):
+                conns.append(db.engine.connect())
+            logger.info(f"Pre-warmed database pool with {len(conns)} connections")
+        except Exception as e:
+            logger.warning(f"Could not pre-warm database pool: {str(e)}")
+        finally:
+            # Closing returns them to the pool ready for reuse
+            for conn in conns:
+                conn.close()
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
@@ -107,21 +257,42 @@ class User(db.Model):
 def ping():
     return jsonify({'status': 'container running'}), 200
 
+# Outcome and time of the last database probe. ?deep=1 reuses a success for HEALTH_CACHE_TTL
+# seconds; plain requests answer from either outcome until it is HEALTH_STALE_AFTER seconds old
+_HEALTH_CACHE = {'checked_at': 0.0, 'database': 'unknown'}
+HEALTH_CACHE_TTL = float(os.environ.get('HEALTH_CACHE_TTL', 5))
+HEALTH_STALE_AFTER = float(os.environ.get('HEALTH_STALE_AFTER', 30))
+
 @app.route('/')
 def health_check():
+    deep = request.args.get('deep') == '1'
+    age = time.monotonic() - _HEALTH_CACHE['checked_at']
+
+    if _HEALTH_CACHE['database'] == 'connected' and age < (HEALTH_CACHE_TTL if deep else HEALTH_STALE_AFTER):
+        return jsonify({'status': 'healthy', 'database': 'connected'}), 200
+    if not deep and _HEALTH_CACHE['database'] == 'disconnected' and age < HEALTH_STALE_AFTER:
+        return jsonify({'status': 'unhealthy', 'database': 'disconnected'}), 503
+
     try:
-        # Try standard db check
-        db.session.execute(text('SELECT 1'))
+        # Probe on a raw autocommit connection so no transaction is left open on the server
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.exec_driver_sql('SELECT 1')
         app.logger.debug('Database connection successful')
+        _HEALTH_CACHE['checked_at'] = time.monotonic()
+        _HEALTH_CACHE['database'] = 'connected'
         return jsonify({'status': 'healthy', 'database': 'connected'}), 200
     except Exception as e:
         error_msg = str(e)
         app.logger.error(f"Health check failed: {error_msg}")
+        _HEALTH_CACHE['checked_at'] = time.monotonic()
+        _HEALTH_CACHE['database'] = 'disconnected'
         
         # If database doesn't exist, try to create it on-demand
         if "does not exist" in error_msg:
             try:
-                if create_database_if_not_exists():
+                if create_database_if_not_exists(*get_db_credentials()):
+                    # Probe again on the next request rather than reporting the failure above
+                    _HEALTH_CACHE['database'] = 'unknown'
                     return jsonify({'status': 'initializing', 'message': 'Database created, restarting connection'}), 200
             except Exception as creation_error:
                 logger.error(f"On-demand database creation failed: {str(creation_error)}")
@@ -136,5 +307,7 @@ if __name__ == '__main__':
             logger.info("Tables created successfully")
         except Exception as e:
             logger.error(f"Error creating tables: {str(e)}")
+
+    warm_db_pool()
     
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,7 @@
+# Picked up automatically by gunicorn from the working directory
+
+def post_worker_init(worker):
+    # Each worker has its own pool after the fork, so fill it before taking requests.
+    # A gthread worker never holds more connections than it has threads
+    from app import warm_db_pool
+    warm_db_pool(worker.cfg.threads)
@@ -32,6 +32,8 @@ class HelloWorldStack(Stack):
             hosted_zone_id: str,
             env_name: str = "dev", 
             region: str = 'eu-central-1', 
+            aurora_instances: int = 3,
+            desired_count: int = 3,
             **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
         # Environment name for resource naming
@@ -46,7 +48,9 @@ class HelloWorldStack(Stack):
         # Create VPC with 3 public and 3 private subnets (matching the architecture diagram)
         vpc = ec2.Vpc(self, f"{self.env_name}-vpc",
             max_azs=3,  # Using 3 AZs as specified
-            nat_gateways=3,  # One NAT gateway per AZ for high availability
+            # One NAT gateway per AZ for high availability in prod; AWS API traffic goes
+            # through the VPC endpoints below, so a single NAT is enough elsewhere
+            nat_gateways=3 if self.env_name == "prod" else 1,
             subnet_configuration=[
                 ec2.SubnetConfiguration(
                     name="public",
@@ -118,6 +122,41 @@ class HelloWorldStack(Stack):
             "Allow MySQL traffic from application"
         )
         
+        # VPC endpoints so AWS API traffic from the tasks (secret fetches, image pulls, log puts)
+        # stays inside the VPC instead of going through the NAT gateways
+        endpoint_sg = ec2.SecurityGroup(self, f"{self.env_name}-endpoint-sg",
+            vpc=vpc,
+            allow_all_outbound=False,
+            description=f"Security group for {self.env_name} VPC endpoints"
+        )
+
+        endpoint_sg.add_ingress_rule(
+            app_sg,
+            ec2.Port.tcp(443),
+            "Allow HTTPS traffic from application"
+        )
+
+        for endpoint_name, endpoint_service in [
+            ("secretsmanager", ec2.InterfaceVpcEndpointAwsService.SECRETS_MANAGER),
+            ("ecr", ec2.InterfaceVpcEndpointAwsService.ECR),
+            ("ecr-docker", ec2.InterfaceVpcEndpointAwsService.ECR_DOCKER),
+            ("logs", ec2.InterfaceVpcEndpointAwsService.CLOUDWATCH_LOGS),
+        ]:
+            ec2.InterfaceVpcEndpoint(self, f"{self.env_name}-{endpoint_name}-endpoint",
+                vpc=vpc,
+                service=endpoint_service,
+                subnets=ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE_WITH_EGRESS),
+                security_groups=[endpoint_sg],
+                open=False  # Only the app security group rule above, not the whole VPC range
+            )
+
+        # ECR image layers are served from S3
+        ec2.GatewayVpcEndpoint(self, f"{self.env_name}-s3-endpoint",
+            vpc=vpc,
+            service=ec2.GatewayVpcEndpointAwsService.S3,
+            subnets=[ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE_WITH_EGRESS)]
+        )
+        
         # RDS Aurora cluster (spread across all 3 AZs)
         db_subnet_group = rds.SubnetGroup(self, f"{self.env_name}-db-subnet-group",
             description=f"Subnet group for {self.env_name} database",
@@ -131,13 +170,28 @@ class HelloWorldStack(Stack):
         )
         
         # Change engine to Aurora PostgreSQL
+        aurora_engine = rds.DatabaseClusterEngine.aurora_postgres(
+            version=rds.AuroraPostgresEngineVersion.of(
+                "16.6",  # Full version
+                "16"    # Major version
+            )
+        )
+
+        # Cluster parameter group: slow query visibility and a larger per-sort work_mem.
+        # max_connections and shared_buffers keep Aurora's memory-based defaults, which already
+        # exceed the app's fan-out (tasks x workers x pool size) and suit Aurora's storage layer
+        parameter_group = rds.ParameterGroup(self, f"{self.env_name}-parameter-group",
+            engine=aurora_engine,
+            description=f"Parameter group for {self.env_name} database",
+            parameters={
+                "shared_preload_libraries": "pg_stat_statements",
+                "log_min_duration_statement": "500",
+                "work_mem": "16384",  # 16MB, in kB
+            }
+        )
+
         aurora_cluster = rds.DatabaseCluster(self, f"{self.env_name}-aurora-cluster",
-        engine=rds.DatabaseClusterEngine.aurora_postgres(
-                version=rds.AuroraPostgresEngineVersion.of(
-                    "16.6",  # Full version
-                    "16"    # Major version
-                )
-            ),
+            engine=aurora_engine,
             credentials=rds.Credentials.from_secret(aurora_secret),
             instance_props=rds.InstanceProps(
                 vpc=vpc,
@@ -145,21 +199,22 @@ class HelloWorldStack(Stack):
                 instance_type=ec2.InstanceType.of(ec2.InstanceClass.M6G, ec2.InstanceSize.LARGE),
                 # instance_type=ec2.InstanceType.of(ec2.InstanceClass.BURSTABLE4_GRAVITON, ec2.InstanceSize.MEDIUM),
             ),
-            instances=9,
+            instances=aurora_instances,  # Defaults to one instance per AZ
             removal_policy=RemovalPolicy.DESTROY,
             deletion_protection=False,
             storage_encrypted=True,
             storage_encryption_key=encryption_key,
             subnet_group=db_subnet_group,
             cloudwatch_logs_exports=["postgresql"],
-            parameter_group=rds.ParameterGroup.from_parameter_group_name(
-                self, f"{self.env_name}-parameter-group",
-                parameter_group_name="default.aurora-postgresql16"
-            ),
+            parameter_group=parameter_group,
             copy_tags_to_snapshot=True,
-            monitoring_interval=Duration.seconds(60)
+            monitoring_interval=Duration.seconds(60),
+            iam_authentication=True
         )
 
+        # Database user the application connects as using IAM auth tokens (created by the app on startup)
+        db_iam_user = "flaskapp"
+
         # ECS Cluster in the private subnet
         cluster = ecs.Cluster(self, f"{self.env_name}-cluster",
             vpc=vpc,
@@ -186,6 +241,14 @@ class HelloWorldStack(Stack):
                             resources=[f"arn:aws:secretsmanager:{Stack.of(self).region}:{Stack.of(self).account}:secret:{self.env_name}-aurora-credentials*"]
                         )
                     ]
+                ),
+                "RdsIamConnect": iam.PolicyDocument(
+                    statements=[
+                        iam.PolicyStatement(
+                            actions=["rds-db:connect"],
+                            resources=[f"arn:aws:rds-db:{Stack.of(self).region}:{Stack.of(self).account}:dbuser:{aurora_cluster.cluster_resource_identifier}/{db_iam_user}"]
+                        )
+                    ]
                 )
             }
         )
@@ -209,7 +272,7 @@ class HelloWorldStack(Stack):
             cluster=cluster,
             cpu=1024,
             memory_limit_mib=2048,
-            desired_count=9,  # One task per AZ for high availability
+            desired_count=desired_count,  # Defaults to one task per AZ for high availability
             task_image_options=ecs_patterns.ApplicationLoadBalancedTaskImageOptions(
                 image=ecs.ContainerImage.from_docker_image_asset(docker_image),
                 container_port=5000,
@@ -218,6 +281,7 @@ class HelloWorldStack(Stack):
                     "ENVIRONMENT": self.env_name,
                     "DB_SECRET_ARN": aurora_secret.secret_arn,
                     "DB_HOST": aurora_cluster.cluster_endpoint.hostname,
+                    "DB_IAM_USER": db_iam_user,
                     "AWS_REGION": self.region
                 },
                 log_driver=ecs.LogDrivers.aws_logs(
@@ -382,6 +446,12 @@ class HelloWorldApp(App):
         hosted_zone_id = self.node.try_get_context("hosted_zone_id")
         hosted_zone_name = self.node.try_get_context("hosted_zone_name")
         env_name = self.node.try_get_context("env_name")
+        # Only passed through when set, so the defaults stay in HelloWorldStack (0 is a valid value)
+        sizing = {}
+        for context_key in ("aurora_instances", "desired_count"):
+            value = self.node.try_get_context(context_key)
+            if value is not None:
+                sizing[context_key] = int(value)
         if not hosted_zone_id:
             raise ValueError("Missing required context variable: 'hosted_zone_id'. Please provide it in cdk.json or via --context.")
         if not hosted_zone_name:
@@ -397,7 +467,9 @@ class HelloWorldApp(App):
         # hosted_zone_name = os.environ.get('HOSTED_ZONE_NAME')
         # hosted_zone_id = os.environ.get('HOSTED_ZONE_ID')
         # Create the stack
-        HelloWorldStack(self, f"HelloWorldStack-{env_name}", hosted_zone_name, hosted_zone_id, env_name=env_name,)
+        HelloWorldStack(self, f"HelloWorldStack-{env_name}", hosted_zone_name, hosted_zone_id, env_name=env_name,
+            **sizing,
+        )
 
 
 app = HelloWorldApp()